@@ -6,11 +6,25 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
-from numba import jit
+from matplotlib.colors import LinearSegmentedColormap, to_rgba
+
+from numba import njit, prange
 
 
 PRECISION = np.float32
 
+# Number of discarded iterations at the beginning of each trajectory,
+# IFS maps are contractive, so their trajectories converge much faster
+WARMUP = 1000
+IFS_WARMUP = 100
+
+# Default number of independent trajectories, fixed, so that the result
+# does not depend on the number of threads
+BLOCKS = 64
+
+# Above this number of points plotf draws a 2D histogram instead of markers
+RASTER_THRESHOLD = 20000
+
 
 def plotf(x, y, win_title='ITERATED FUNCTION SYSTEM FRACTAL', color='#0080FF'):
     """
@@ -34,6 +48,13 @@ def plotf(x, y, win_title='ITERATED FUNCTION SYSTEM FRACTAL', color='#0080FF'):
 
 
     This function does not return any value.
+
+
+    Notes:
+
+    ** Sets of more than RASTER_THRESHOLD points are binned into a raster
+       with one bin per screen pixel, shade of a pixel depends on a number
+       of points.
     """
 
     plt.ioff()
@@ -45,62 +66,171 @@ def plotf(x, y, win_title='ITERATED FUNCTION SYSTEM FRACTAL', color='#0080FF'):
     plt.axis('off')
     plt.axis('equal')
 
-    plot_options = {
-        'color': color,
-        'alpha': 0.5,
-        'linestyle': '',
-        'marker': 'o',
-        'markersize': 1,
-        'markeredgewidth': 0,
-        'markeredgecolor': '#CC2EFA',
-        'markerfacecolor': '#00BFFF'
-    }
-
-    plt.plot(x, y, **plot_options)
+    face_color = '#00BFFF'
+
+    if len(x) > RASTER_THRESHOLD:
+        # Drawing a single image is much cheaper than drawing every point
+        # as a separate marker, bins match screen pixels of the axes, so that
+        # no bin is dropped by resampling, empty pixels stay transparent
+        extent = plt.gca().get_window_extent()
+        bins = (max(int(extent.width), 1), max(int(extent.height), 1))
+
+        counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins)
+        counts = np.ma.masked_equal(counts.T, 0)
+
+        image_options = {
+            'cmap': LinearSegmentedColormap.from_list(
+                win_title, (to_rgba(face_color, 0.5), to_rgba(face_color, 1.0))),
+            'origin': 'lower',
+            'extent': (x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]),
+            'interpolation': 'antialiased'
+        }
+
+        plt.imshow(np.log1p(counts), **image_options)
+
+    else:
+        plot_options = {
+            'color': color,
+            'alpha': 0.5,
+            'linestyle': '',
+            'marker': 'o',
+            'markersize': 1,
+            'markeredgewidth': 0,
+            'markeredgecolor': '#CC2EFA',
+            'markerfacecolor': face_color
+        }
+
+        plt.plot(x, y, **plot_options)
+
     plt.show()
 
 
-@jit(nopython=True)
-def ifs(lvl, p, a, b, c, d, e, f):
+@njit('float32[:, ::1](int64, float32[:, ::1], int32[:, ::1], float32[:, ::1], int64)',
+      parallel=True, fastmath=True, boundscheck=False, cache=True)
+def ifs_kernel(lvl, params, idx, init, warmup):
+    """
+    Inputs:
+
+    lvl -- integer, number of points
+
+    params
+    -- 2D numpy array of floats, one row per affine map
+    -- columns hold IFS parameters p, a, b, c, d, e, f
+
+    idx
+    -- 2D numpy array of integers, one row per block
+    -- row of params to apply in each iteration of a block
+    -- each row holds at least warmup + lvl / blocks indexes
+
+    init
+    -- 2D numpy array of floats, one row per block
+    -- xy coordinates of the starting point of a block
+
+    warmup -- integer, number of discarded iterations of each block
+
+
+    Return 2D numpy array of size lvl x 2 with calculated xy coordinates,
+    x and y of a point are stored next to each other.
+    """
+
+    blocks = init.shape[0]
+    size = -(-lvl // blocks)
+
+    # Container to store xy components/coordinates of points on a plane
+    points = np.empty(shape=(lvl, 2), dtype=PRECISION)
+
+    # Each block is an independent trajectory, its first points are
+    # discarded, so that the starting point has no visible effect
+    for k in prange(blocks):
+
+        # i -- index for containers
+        # j -- index for parameters
+
+        x_curr = init[k, 0]
+        y_curr = init[k, 1]
+
+        for i in range(warmup):
+            j = idx[k, i]
+            x_prev = x_curr
+            x_curr = params[j, 1] * x_prev + params[j, 2] * y_curr + params[j, 5]
+            y_curr = params[j, 3] * x_prev + params[j, 4] * y_curr + params[j, 6]
+
+        for i in range(k * size, min((k + 1) * size, lvl)):
+            points[i, 0] = x_curr
+            points[i, 1] = y_curr
+            j = idx[k, warmup + i - k * size]
+            x_prev = x_curr
+            x_curr = params[j, 1] * x_prev + params[j, 2] * y_curr + params[j, 5]
+            y_curr = params[j, 3] * x_prev + params[j, 4] * y_curr + params[j, 6]
+
+    return points
+
+
+def ifs(lvl, params, blocks=BLOCKS, seed=None):
     """
     Inputs:
 
     lvl -- integer, number of iterations
 
-    p, a, b, c, d, e, f
-    -- tuple, list, or numpy array of numbers
-    -- IFS parameters
-    -- all must have the same length
-    -- p must be sorted in descending order and other
-       parameters must be adjusted accordingly
+    params
+    -- 2D numpy array of floats, one row per affine map
+    -- columns hold IFS parameters p, a, b, c, d, e, f
+    -- rows must be sorted by p in descending order
+
+    blocks
+    -- positive integer, number of independent trajectories
+       computed in parallel
+    -- default: BLOCKS
+    -- limited, so that discarded iterations do not outnumber points
+
+    seed
+    -- integer, seed of the random number generator
+    -- default: None, fresh entropy from the operating system
 
 
     Return a tuple with two 1D numpy arrays, each of size lvl + 1,
     with calculated xy coordinates.
+
+
+    Notes:
+
+    ** Points come from several randomly started trajectories, so the result
+       is statistically equivalent, but not identical, to a single one.
     """
 
+    if blocks < 1:
+        raise ValueError('blocks must be a positive integer')
+
     lvl += 1
-    param_indexes = range(len(p))
 
-    # Containers to store xy components/coordinates of points on a plane
-    x = np.zeros(shape=lvl, dtype=PRECISION)
-    y = np.zeros(shape=lvl, dtype=PRECISION)
+    blocks = min(blocks, -(-lvl // IFS_WARMUP))
+    size = -(-lvl // blocks)
 
-    for i in range(1, lvl):
+    rng = np.random.default_rng(seed)
 
-        temp = np.random.random()
+    # Reverse the order of maps, so that thresholds p are ascending
+    params = np.ascontiguousarray(params[::-1], dtype=PRECISION)
 
-        # i -- index for containers
-        # j -- index for parameters
+    # The first threshold is the sentinel, every random number is greater,
+    # so the index of a map is the number of other thresholds below
+    # the random number
+    thresholds = params[1:, 0].copy()
 
-        for j in param_indexes:
+    # Map j is applied when a random number is greater than its threshold
+    # and not greater than the threshold of map j + 1
+    temp = rng.random((blocks, IFS_WARMUP + size), dtype=PRECISION)
 
-            if temp > p[j]:
-                x[i] = a[j] * x[i - 1] + b[j] * y[i - 1] + e[j]
-                y[i] = c[j] * x[i - 1] + d[j] * y[i - 1] + f[j]
-                break
+    # Fill int32 indexes row by row, so that the int64 result
+    # of searchsorted never exists for the whole table
+    idx = np.empty(shape=temp.shape, dtype=np.int32)
+    for k in range(blocks):
+        idx[k] = np.searchsorted(thresholds, temp[k])
 
-    return x, y
+    init = rng.random((blocks, 2), dtype=PRECISION)
+
+    points = ifs_kernel(lvl, params, idx, init, IFS_WARMUP)
+
+    return points[:, 0], points[:, 1]
 
 
 def spiral(lvl):
@@ -111,7 +241,8 @@ def spiral(lvl):
     d = (0.859848, 0.053030, 0.181818)
     e = (1.758647, -6.721654, 6.086107)
     f = (1.408065, 1.377236, 1.568035)
-    x, y = ifs(lvl, p, a, b, c, d, e, f)
+    params = np.array(tuple(zip(p, a, b, c, d, e, f)), dtype=PRECISION)
+    x, y = ifs(lvl, params)
     plotf(x, y, 'IFS SPIRAL')
 
 
@@ -123,7 +254,8 @@ def dragon(lvl):
     d = (0.864198, -0.377778)
     e = (-1.882290, 0.785360)
     f = (-0.110607, 8.095795)
-    x, y = ifs(lvl, p, a, b, c, d, e, f)
+    params = np.array(tuple(zip(p, a, b, c, d, e, f)), dtype=PRECISION)
+    x, y = ifs(lvl, params)
     plotf(x, y, 'IFS DRAGON')
 
 
@@ -135,7 +267,8 @@ def fern_leaf(lvl):
     d = (0.85, 0.24, 0.22, 0.16)
     e = (0.0, 0.0, 0.0, 0.0)
     f = (1.6, 0.44, 1.6, 0.0)
-    x, y = ifs(lvl, p, a, b, c, d, e, f)
+    params = np.array(tuple(zip(p, a, b, c, d, e, f)), dtype=PRECISION)
+    x, y = ifs(lvl, params)
     plotf(x, y, 'IFS FERN LEAF')
 
 
@@ -147,7 +280,8 @@ def maple_leaf(lvl):
     d = (0.5, 0.47, 0.51, 0.51)
     e = (1.49, -1.62, 0.02, -0.08)
     f = (-0.75, -0.74, 1.62, -1.31)
-    x, y = ifs(lvl, p, a, b, c, d, e, f)
+    params = np.array(tuple(zip(p, a, b, c, d, e, f)), dtype=PRECISION)
+    x, y = ifs(lvl, params)
     plotf(x, y, 'IFS MAPLE LEAF')
 
 
@@ -159,12 +293,59 @@ def sierpinski_triangle(lvl):
     d = (0.5, 0.5, 0.5)
     e = (0.5, -0.5, -0.5)
     f = (-0.5, 0.5, -0.5)
-    x, y = ifs(lvl, p, a, b, c, d, e, f)
+    params = np.array(tuple(zip(p, a, b, c, d, e, f)), dtype=PRECISION)
+    x, y = ifs(lvl, params)
     plotf(x, y, 'IFS SIERPINSKI TRIANGLE')
 
 
-@jit(nopython=True)
-def clifford_attractor(lvl, a, b, c, d):
+@njit('float32[:, ::1](int64, float32, float32, float32, float32, float32[:, ::1], int64)',
+      parallel=True, fastmath=True, boundscheck=False, cache=True)
+def clifford_kernel(lvl, a, b, c, d, init, warmup):
+    """
+    Inputs:
+
+    lvl -- integer, number of points
+
+    a, b, c, d -- numeric parameters
+
+    init
+    -- 2D numpy array of floats, one row per block
+    -- xy coordinates of the starting point of a block
+
+    warmup -- integer, number of discarded iterations of each block
+
+
+    Return 2D numpy array of size lvl x 2 with calculated xy coordinates,
+    x and y of a point are stored next to each other.
+    """
+
+    blocks = init.shape[0]
+    size = -(-lvl // blocks)
+
+    # Container to store xy components/coordinates of points on a plane
+    points = np.empty(shape=(lvl, 2), dtype=PRECISION)
+
+    for k in prange(blocks):
+
+        x_curr = init[k, 0]
+        y_curr = init[k, 1]
+
+        for _ in range(warmup):
+            x_prev = x_curr
+            x_curr = np.sin(a * y_curr) + c * np.cos(a * x_prev)
+            y_curr = np.sin(b * x_prev) + d * np.cos(b * y_curr)
+
+        for i in range(k * size, min((k + 1) * size, lvl)):
+            points[i, 0] = x_curr
+            points[i, 1] = y_curr
+            x_prev = x_curr
+            x_curr = np.sin(a * y_curr) + c * np.cos(a * x_prev)
+            y_curr = np.sin(b * x_prev) + d * np.cos(b * y_curr)
+
+    return points
+
+
+def clifford_attractor(lvl, a, b, c, d, blocks=BLOCKS):
     """
     Inputs:
 
@@ -172,20 +353,126 @@ def clifford_attractor(lvl, a, b, c, d):
 
     a, b, c, d -- numeric parameters
 
+    blocks
+    -- positive integer, number of independent trajectories
+       computed in parallel
+    -- default: BLOCKS
+    -- limited, so that discarded iterations do not outnumber points
+
 
     Return a tuple with two 1D numpy arrays, each of size lvl + 1,
     with calculated xy coordinates.
+
+
+    Notes:
+
+    ** Points come from several trajectories with different starting points,
+       so the result is statistically equivalent, but not identical,
+       to a single one.
     """
 
+    if blocks < 1:
+        raise ValueError('blocks must be a positive integer')
+
     lvl += 1
 
+    blocks = min(blocks, -(-lvl // WARMUP))
+
+    # Starting points of blocks, fixed so that the result is repeatable
+    init = np.random.default_rng(0).random((blocks, 2)).astype(PRECISION)
+
+    # Parameters in the same precision as points keep the loop in float32
+    a, b, c, d = (PRECISION(param) for param in (a, b, c, d))
+
+    points = clifford_kernel(lvl, a, b, c, d, init, WARMUP)
+
+    return points[:, 0], points[:, 1]
+
+
+@njit(fastmath=True, boundscheck=False, cache=True)
+def clifford_ensemble_kernel(steps, a, b, c, d, init):
+    """
+    Inputs:
+
+    steps -- integer, number of iterations of each trajectory
+
+    a, b, c, d -- numeric parameters
+
+    init
+    -- 2D numpy array of floats, one row per trajectory
+    -- xy coordinates of the starting point of a trajectory
+
+
+    Return a tuple with two 2D numpy arrays, each of size steps x ensemble,
+    with calculated xy coordinates, one column per trajectory.
+    """
+
+    ensemble = init.shape[0]
+
     # Containers to store xy components/coordinates of points on a plane
-    x = np.zeros(shape=lvl, dtype=PRECISION)
-    y = np.zeros(shape=lvl, dtype=PRECISION)
+    x = np.empty(shape=(steps, ensemble), dtype=PRECISION)
+    y = np.empty(shape=(steps, ensemble), dtype=PRECISION)
+
+    x[0, :] = init[:, 0]
+    y[0, :] = init[:, 1]
+
+    # All trajectories advance in lock-step, the inner loop has no
+    # dependencies between iterations and can be vectorized
+    for i in range(1, steps):
+        for k in range(ensemble):
+            x[i, k] = np.sin(a * y[i - 1, k]) + c * np.cos(a * x[i - 1, k])
+            y[i, k] = np.sin(b * x[i - 1, k]) + d * np.cos(b * y[i - 1, k])
+
+    return x, y
+
+
+def clifford_ensemble(lvl, a, b, c, d, ensemble=8):
+    """
+    Inputs:
+
+    lvl -- integer, number of iterations
+
+    a, b, c, d -- numeric parameters
+
+    ensemble
+    -- positive integer, number of trajectories computed side by side
+    -- default: 8
+
+
+    Return a tuple with two 1D numpy arrays, each of size lvl + 1,
+    with calculated xy coordinates.
+
+
+    Notes:
+
+    ** Like clifford_attractor, but trajectories are computed in a single
+       thread with SIMD instructions instead of in parallel threads.
+
+    ** The result is statistically equivalent, but not identical,
+       to a single trajectory.
+
+    ** Each trajectory discards its first WARMUP iterations, so
+       ensemble * WARMUP iterations are computed on top of lvl.
+    """
+
+    if ensemble < 1:
+        raise ValueError('ensemble must be a positive integer')
+
+    lvl += 1
+
+    steps = WARMUP + -(-lvl // ensemble)
+
+    # Starting points of trajectories, fixed so that the result is repeatable
+    init = np.random.default_rng(0).random((ensemble, 2)).astype(PRECISION)
+
+    # Parameters in the same precision as points keep the loop in float32
+    a, b, c, d = (PRECISION(param) for param in (a, b, c, d))
+
+    x, y = clifford_ensemble_kernel(steps, a, b, c, d, init)
 
-    for i in range(1, lvl):
-        x[i] = np.sin(a * y[i - 1]) + c * np.cos(a * x[i - 1])
-        y[i] = np.sin(b * x[i - 1]) + d * np.cos(b * y[i - 1])
+    # Discard the transient and join all trajectories
+    x = x[WARMUP:].ravel()[:lvl]
+    y = y[WARMUP:].ravel()[:lvl]
 
     return x, y
 
@@ -199,3 +486,4 @@ if __name__ == '__main__':
     # plotf(*clifford_attractor(100000, 1.5, -1.8, 1.6, 0.9), 'CLIFFORD ATTRACTOR', '#045FB4')
     plotf(*clifford_attractor(90000, 1.7, 1.7, 0.06, 1.2), 'CLIFFORD ATTRACTOR', '#045FB4')
     # plotf(*clifford_attractor(100000, -1.4, 1.6, 1.0, 0.7), 'CLIFFORD ATTRACTOR', '#045FB4')
+    # plotf(*clifford_ensemble(100000, -1.4, 1.6, 1.0, 0.7), 'CLIFFORD ATTRACTOR', '#045FB4')
@@ -3,12 +3,20 @@
 """FRACTALS: LINDENMAYER SYSTEM"""
 
 
+from functools import lru_cache
+
 import numpy as np
 import matplotlib.pyplot as plt
 
+from numba import njit
+
 
 PRECISION = np.float32
 
+# Symbols which are drawn, all other symbols are rewrite rule flags
+DRAWING_RULES = b'F+-'
+FLAGS = bytes(i for i in range(256) if i not in DRAWING_RULES)
+
 
 def calc_rot_matrix(angle):
     """
@@ -24,8 +32,83 @@ def calc_rot_matrix(angle):
     Returns 2x2 numpy array of floats, a 2D rotation matrix.
     """
 
-    return np.array([[np.cos(angle), -np.sin(angle)],
-                     [np.sin(angle), np.cos(angle)]], dtype=PRECISION)
+    cos = PRECISION(np.cos(angle))
+    sin = PRECISION(np.sin(angle))
+
+    rot_matrix = np.empty(shape=(2, 2), dtype=PRECISION)
+    rot_matrix[0, 0] = cos
+    rot_matrix[0, 1] = -sin
+    rot_matrix[1, 0] = sin
+    rot_matrix[1, 1] = cos
+
+    return rot_matrix
+
+
+@njit(boundscheck=False, cache=True)
+def rewrite(states, rule_data, rule_off, rule_len):
+    """
+    Inputs:
+
+    states -- 1D numpy array of uint8, symbols of the system
+
+    rule_data
+    -- 1D numpy array of uint8
+    -- replacement rules of all 256 byte values, one after another
+
+    rule_off, rule_len
+    -- 1D numpy arrays of integers, each of size 256
+    -- offset and length of the replacement rule of a byte value in rule_data
+
+
+    Returns 1D numpy array of uint8, states after a single rewrite.
+    """
+
+    # First pass: measure the output, so that it is allocated only once
+    total = 0
+    for symbol in states:
+        total += rule_len[symbol]
+
+    new_states = np.empty(shape=total, dtype=np.uint8)
+
+    # Second pass: copy whole replacement rules
+    pos = 0
+    for symbol in states:
+        off = rule_off[symbol]
+        size = rule_len[symbol]
+        new_states[pos:pos + size] = rule_data[off:off + size]
+        pos += size
+
+    return new_states
+
+
+def calc_rule_table(rewrite_rules):
+    """
+    Input:
+
+    rewrite_rules
+    -- iterable of pairs
+    -- first item (character) -> symbol
+    -- second item (string) -> replacement rule
+
+
+    Returns list of 256 bytes, replacement rule of each byte value.
+
+
+    Notes:
+
+    ** Symbols must be single ASCII characters, otherwise ValueError
+       is raised. Other characters of rules are encoded in UTF-8.
+    """
+
+    # Characters without a rule are copied
+    table = [bytes([i]) for i in range(256)]
+    for symbol, rule in rewrite_rules:
+        if len(symbol) != 1 or not symbol.isascii():
+            raise ValueError(
+                'rewrite rule symbol must be a single ASCII character: {!r}'.format(symbol))
+        table[ord(symbol)] = rule.encode('utf-8')
+
+    return table
 
 
 def generate_pattern(lvl, states, rewrite_rules):
@@ -44,22 +127,268 @@ def generate_pattern(lvl, states, rewrite_rules):
     -- values (string) -> replacement rules
 
 
-    Returns string of symbols.
+    Returns bytes of symbols.
+    """
+
+    return clean_pattern(lvl, states, tuple(sorted(rewrite_rules.items())))
+
+
+@lru_cache(maxsize=64)
+def clean_pattern(lvl, states, rewrite_rules):
+    """
+    Inputs:
+
+    lvl
+    -- integer number
+    -- the number of times (iterations) rewrite rules will be applied
+
+    states -- string, the initial state (axiom) of the system
+
+    rewrite_rules
+    -- tuple of pairs, sorted by symbol
+    -- first item (character) -> symbol
+    -- second item (string) -> replacement rule
+
+
+    Returns bytes of symbols, without rewrite rule flags.
+
+
+    Notes:
+
+    ** Results are cached, repeated calls with the same arguments
+       return the same bytes object without rewriting states again.
+       Only the filtered states are kept, the unfiltered ones are not cached.
+    """
+
+    states = rewrite_pattern(lvl + 1, states, rewrite_rules)
+
+    # Clean states form rewrite rule flags/symbols
+    return states.translate(None, FLAGS)
+
+
+@lru_cache(maxsize=64)
+def expand_pattern(lvl, states, rewrite_rules):
     """
+    Inputs:
+
+    lvl
+    -- integer number
+    -- the number of rewrites
+
+    states -- string, the initial state (axiom) of the system
+
+    rewrite_rules
+    -- tuple of pairs, sorted by symbol
+    -- first item (character) -> symbol
+    -- second item (string) -> replacement rule
+
+
+    Returns bytes of symbols, including rewrite rule flags.
+
+
+    Notes:
+
+    ** Results are cached, repeated calls with the same arguments
+       return the same bytes object without rewriting states again.
+    """
+
+    return rewrite_pattern(lvl, states, rewrite_rules)
+
+
+def rewrite_pattern(lvl, states, rewrite_rules):
+    """
+    Inputs:
+
+    lvl
+    -- integer number
+    -- the number of rewrites
+
+    states -- string, the initial state (axiom) of the system
+
+    rewrite_rules
+    -- iterable of pairs
+    -- first item (character) -> symbol
+    -- second item (string) -> replacement rule
+
+
+    Returns bytes of symbols, including rewrite rule flags.
+    """
+
+    # Lookup table: byte value of a symbol -> its replacement rule
+    table = calc_rule_table(rewrite_rules)
+
+    # Pack all rules into a single buffer with offsets and lengths
+    rule_data = np.frombuffer(b''.join(table), dtype=np.uint8)
+    rule_len = np.array([len(rule) for rule in table], dtype=np.int32)
+    rule_off = np.zeros(shape=256, dtype=np.int32)
+    rule_off[1:] = np.cumsum(rule_len[:-1])
+
+    states = np.frombuffer(states.encode('utf-8'), dtype=np.uint8)
 
     # In each iteration: check every character in states, replace valid symbol
     # with rewrite rule or copy character, and update states
-    for _ in range(lvl + 1):
-        states = ''.join([rewrite_rules.get(symbol, symbol) for symbol in states])
+    for _ in range(lvl):
+        states = rewrite(states, rule_data, rule_off, rule_len)
 
-    # Clean states form rewrite rule flags/symbols
-    drawing_rules = 'F+-'
-    states = ''.join([symbol for symbol in states if symbol in drawing_rules])
+    return states.tobytes()
+
+
+@njit(boundscheck=False, cache=True)
+def walk(states, vec, rot_left, rot_right):
+    """
+    Inputs:
+
+    states -- 1D numpy array of uint8, symbols of the system
+
+    vec -- 2x1 numpy array of floats, initial displacement vector
 
-    return states
+    rot_left, rot_right -- 2x2 numpy arrays of floats, rotation matrices
 
 
-def generate_points(alpha, theta, length, states):
+    Returns numpy array of coordinates of points on a plane.
+    """
+
+    # Container to store xy components/coordinates of points on a plane,
+    # sized as if every symbol was F, so that states are traversed only once
+    points = np.empty(shape=(2, states.shape[0] + 1), dtype=PRECISION)
+    points[:, 0] = 0
+
+    # Displacement vector and position are kept in scalar registers
+    vec_x = vec[0, 0]
+    vec_y = vec[1, 0]
+    pos_x = points[0, 0]
+    pos_y = points[1, 0]
+
+    point_index = 1
+
+    for st in states:
+        if st == ord('+'):
+            vec_x, vec_y = (rot_right[0, 0] * vec_x + rot_right[0, 1] * vec_y,
+                            rot_right[1, 0] * vec_x + rot_right[1, 1] * vec_y)
+        elif st == ord('-'):
+            vec_x, vec_y = (rot_left[0, 0] * vec_x + rot_left[0, 1] * vec_y,
+                            rot_left[1, 0] * vec_x + rot_left[1, 1] * vec_y)
+        elif st == ord('F'):
+            pos_x += vec_x
+            pos_y += vec_y
+            points[0, point_index] = pos_x
+            points[1, point_index] = pos_y
+            point_index += 1
+
+    return points[:, :point_index]
+
+
+@njit(boundscheck=False, cache=True)
+def walk_rules(states, vec, steps, step_off, step_len, turns):
+    """
+    Inputs:
+
+    states -- 1D numpy array of uint8, symbols of the system
+
+    vec -- 2x1 numpy array of floats, initial displacement vector
+
+    steps
+    -- 2D numpy array of floats, 2 rows
+    -- points of the rewrite rules, relative to the start of a rule,
+       for the unit displacement vector along the x axis
+
+    step_off, step_len
+    -- 1D numpy arrays of integers, each of size 256
+    -- offset and number of points of the rewrite rule of a byte value
+
+    turns
+    -- 2D numpy array of floats, 2 rows and 256 columns
+    -- cosine and sine of the net rotation of the rewrite rule of a byte value
+
+
+    Returns numpy array of coordinates of points on a plane
+    of states rewritten once.
+    """
+
+    # First pass: count points, so that the container is allocated only once
+    n_points = 1
+    for st in states:
+        n_points += step_len[st]
+
+    # Container to store xy components/coordinates of points on a plane
+    points = np.zeros(shape=(2, n_points), dtype=PRECISION)
+
+    vec_x = vec[0, 0]
+    vec_y = vec[1, 0]
+    pos_x = points[0, 0]
+    pos_y = points[1, 0]
+
+    point_index = 1
+
+    # Second pass: the whole rewrite rule of a symbol is one composite step,
+    # its points are rotated and scaled by the current displacement vector
+    for st in states:
+        off = step_off[st]
+        for j in range(off, off + step_len[st]):
+            points[0, point_index] = pos_x + vec_x * steps[0, j] - vec_y * steps[1, j]
+            points[1, point_index] = pos_y + vec_y * steps[0, j] + vec_x * steps[1, j]
+            point_index += 1
+
+        pos_x = points[0, point_index - 1]
+        pos_y = points[1, point_index - 1]
+
+        vec_x, vec_y = (vec_x * turns[0, st] - vec_y * turns[1, st],
+                        vec_y * turns[0, st] + vec_x * turns[1, st])
+
+    return points
+
+
+def calc_rule_steps(theta, rot_left, rot_right, rewrite_rules):
+    """
+    Inputs:
+
+    theta -- float number, angle (in radians) of a single rotation
+
+    rot_left, rot_right -- 2x2 numpy arrays of floats, rotation matrices
+
+    rewrite_rules
+    -- dictionary
+    -- keys (character) -> symbols
+    -- values (string) -> replacement rules
+
+
+    Returns tuple of steps, step_off, step_len and turns tables for walk_rules.
+    """
+
+    unit_vec = np.array([[1], [0]], dtype=PRECISION)
+
+    rules = [rule.translate(None, FLAGS)
+             for rule in calc_rule_table(rewrite_rules.items())]
+
+    # Tables are allocated once and filled in place
+    step_len = np.array([rule.count(b'F') for rule in rules], dtype=np.int64)
+    step_off = np.zeros(shape=256, dtype=np.int64)
+    step_off[1:] = np.cumsum(step_len[:-1])
+
+    steps = np.empty(shape=(2, step_len.sum()), dtype=PRECISION)
+
+    # Symbols without drawing rules keep the displacement vector unchanged
+    turns = np.zeros(shape=(2, 256), dtype=PRECISION)
+    turns[0, :] = 1
+
+    for symbol, rule in enumerate(rules):
+        if not rule:
+            continue
+
+        off = step_off[symbol]
+        size = step_len[symbol]
+        points = walk(np.frombuffer(rule, dtype=np.uint8), unit_vec, rot_left, rot_right)
+        steps[:, off:off + size] = points[:, 1:]
+
+        # Net rotation of the rule, + turns right and - turns left
+        net_angle = theta * (rule.count(b'-') - rule.count(b'+'))
+        turns[0, symbol] = np.cos(net_angle)
+        turns[1, symbol] = np.sin(net_angle)
+
+    return steps, step_off, step_len, turns
+
+
+def generate_points(alpha, theta, length, states, rewrite_rules=None):
     """
     Inputs:
 
@@ -76,7 +405,13 @@ def generate_points(alpha, theta, length, states):
     -- integer or float number
     -- length of a displacement vector for one step
 
-    states -- string of symbols
+    states -- string or bytes of symbols
+
+    rewrite_rules
+    -- dictionary, optional
+    -- keys (character) -> symbols
+    -- values (string) -> replacement rules
+    -- if given, states are rewritten once more while points are generated
 
 
     Retrurns numpy array of coordinates of points on a plane.
@@ -88,38 +423,33 @@ def generate_points(alpha, theta, length, states):
        in the origin of the coordinate system.
 
     ** Only character F in states (alphabet) generates a new point.
-    """
 
-    # Convert angles from degrees to radians
-    alpha = np.radians(alpha)
-    theta = np.radians(theta)
+    ** With rewrite_rules the last rewrite is never stored, the walk
+       over states takes a whole rewrite rule in a single step.
+    """
 
-    # Displacement vector, 2x1 numpy array
-    vec = np.array([[np.cos(alpha)], [np.sin(alpha)]], dtype=PRECISION)
-    vec_len = np.sqrt(vec[0] ** 2 + vec[1] ** 2)
+    # Convert angles from degrees to radians, keep them in the same precision
+    # as points, so that numpy does not promote intermediate results
+    alpha = PRECISION(np.radians(alpha))
+    theta = PRECISION(np.radians(theta))
 
-    # Rescale displacement vector
-    vec = vec / vec_len * length
+    # Displacement vector, 2x1 numpy array, [cos, sin] is already a unit vector
+    vec = np.array([[length * np.cos(alpha)], [length * np.sin(alpha)]], dtype=PRECISION)
 
     # Rotation matrices for positive and negative angles
     rot_left = calc_rot_matrix(theta)
     rot_right = calc_rot_matrix(-theta)
 
-    # Container to store xy components/coordinates of points on a plane
-    points = np.zeros(shape=(2, states.count('F') + 1), dtype=PRECISION)
+    if isinstance(states, str):
+        states = states.encode('utf-8')
 
-    point_index = 1
+    states = np.frombuffer(states, dtype=np.uint8)
 
-    for st in states:
-        if st == '+':
-            vec = np.dot(rot_right, vec)
-        elif st == '-':
-            vec = np.dot(rot_left, vec)
-        else:
-            points[:, point_index] = points[:, point_index - 1] + vec[:, 0]
-            point_index += 1
+    if rewrite_rules is not None:
+        rule_steps = calc_rule_steps(theta, rot_left, rot_right, rewrite_rules)
+        return walk_rules(states, vec, *rule_steps)
 
-    return points
+    return walk(states, vec, rot_left, rot_right)
 
 
 def lindemayer(lvl, length, init_angle, angle, init_state,
@@ -163,8 +493,9 @@ def lindemayer(lvl, length, init_angle, angle, init_state,
     This function does not return any value.
     """
 
-    states = generate_pattern(lvl, init_state, rewrite_rules)
-    points = generate_points(init_angle, angle, length, states)
+    # The last rewrite is done by generate_points
+    states = expand_pattern(lvl, init_state, tuple(sorted(rewrite_rules.items())))
+    points = generate_points(init_angle, angle, length, states, rewrite_rules)
 
     plt.ioff()
 